@@ -1,11 +1,46 @@
+import asyncio
+import hashlib
+import logging
+import orjson
 import requests
 import os
+import re
+import tempfile
 from collections import defaultdict
-from urllib.parse import urljoin
+from os.path import expanduser
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# <patient>-<rest>_..., e.g. C-0EU9LX-L015-d_cl_aln_srt.bam -> patient C-0EU9LX, sample C-0EU9LX-L015-d
+_FILE_NAME_RE = re.compile(r'^(?P<sample>(?P<patient>[^-_]*-[^-_]*)-[^_]*)_')
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]))
+_session.mount('http://', _adapter)
+_session.mount('https://', _adapter)
+_session.headers.update({'Accept-Encoding': 'gzip', 'Accept': 'application/json'})
+
+# one [etag, body] file per url
+ETAG_CACHE_LOCATION = os.path.join(expanduser("~"), '.cache', 'beagle_cli', 'etags')
+ETAG_CACHE_MAX_ENTRIES = 4096
+_etags_pruned = False
+
+class BeagleUrls(object):
+
+    def __init__(self, config):
+        base = config['beagle_endpoint'].rstrip('/')
+        self.pipelines = "{}/{}".format(base, config['api']['pipelines'].lstrip('/'))
+        self.run = "{}/{}".format(base, config['api']['run'].lstrip('/'))
+
 
 def access_commands(arguments, config):
     print('Running ACCESS')
+    config['urls'] = BeagleUrls(config)
     if arguments.get('link-bams'):
         return run_access_folder_bam_link_command(arguments, config)
 
@@ -13,36 +48,87 @@ def access_commands(arguments, config):
         return run_access_folder_link_command(arguments, config)
 
 
+def _client(config):
+    if 'Authorization' not in _session.headers:
+        _session.headers['Authorization'] = 'Bearer %s' % config['token']
+    return _session
+
+def _etag_path(url):
+    return os.path.join(ETAG_CACHE_LOCATION, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+def _load_etag(url):
+    try:
+        with open(_etag_path(url), 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def _reuse_etag(url, cached_response):
+    # bump mtime so pruning drops the least recently used entries first
+    try:
+        os.utime(_etag_path(url))
+    except OSError:
+        pass
+    return cached_response[1]
+
+def _prune_etags():
+    global _etags_pruned
+    if _etags_pruned:
+        return
+    _etags_pruned = True
+
+    entries = []
+    for entry in os.scandir(ETAG_CACHE_LOCATION):
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            pass
+    entries.sort()
+    for (_, path) in entries[:max(0, len(entries) - ETAG_CACHE_MAX_ENTRIES)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _remember_etag(url, etag, body):
+    if not etag:
+        return
+    tmp_path = None
+    try:
+        os.makedirs(ETAG_CACHE_LOCATION, exist_ok=True)
+        _prune_etags()
+        # write then rename, so concurrent invocations never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=ETAG_CACHE_LOCATION, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps([etag, body]))
+        os.replace(tmp_path, _etag_path(url))
+    except OSError as e:
+        logger.warning("could not write etag cache entry for '%s': %s", url, e)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _conditional_get(url, config):
+    cached_response = _load_etag(url)
+    headers = {'If-None-Match': cached_response[0]} if cached_response else {}
+    response = _client(config).get(url, headers=headers)
+    if response.status_code == 304 and cached_response:
+        return _reuse_etag(url, cached_response)
+
+    body = orjson.loads(response.content)
+    if response.ok:
+        _remember_etag(url, response.headers.get('ETag'), body)
+    return body
+
 def get_pipeline(name, config):
-    response = requests.get(urljoin(config['beagle_endpoint'],
-                                    "{}?name={}".format(config['api']['pipelines'], name)),
-                            headers={'Authorization': 'Bearer %s' % config['token']})
+    url = config['urls'].pipelines + "?name={}".format(name)
 
     try:
-        pipeline = response.json()["results"][0]
+        pipeline = _conditional_get(url, config)["results"][0]
     except Exception as e:
         print("Pipeline 'access legacy' does not exist")
         quit()
     return pipeline
 
-def get_group_id(tags, apps, config):
-    latest_run_params = {
-        "tags": tags,
-        "status": "COMPLETED",
-        "page_size": 1,
-        "apps": apps
-    }
-
-    response = requests.get(urljoin(config['beagle_endpoint'], config['api']['run']),
-                            headers={'Authorization': 'Bearer %s' % config['token']}, params=latest_run_params)
-
-    latest_runs = response.json()["results"]
-    if not latest_runs:
-        print("There are no runs for this id")
-        quit()
-
-    return latest_runs[0]["job_group"]
-
 def get_arguments(arguments):
     request_id = arguments.get('--request-id')
     sample_id = arguments.get('--sample-id')
@@ -51,34 +137,99 @@ def get_arguments(arguments):
     return request_id, sample_id
 
 
-def get_runs(tags, apps, config):
-    group_id = get_group_id(tags, apps, config)
+def _get_page(url, config, params=None):
+    response = _client(config).get(url, params=params)
+
+    return orjson.loads(response.content)
 
+def iter_runs(tags, apps, config, page_size=200):
     run_params = {
         "tags": tags,
         "status": "COMPLETED",
-        "page_size": 1000,
-        "job_groups": [group_id],
+        "page_size": page_size,
+        "ordering": "-created_date",
         "apps": apps
     }
 
-    response = requests.get(urljoin(config['beagle_endpoint'], config['api']['run']),
-                            headers={'Authorization': 'Bearer %s' % config['token']}, params=run_params)
-
-    return response.json()["results"]
-
-def get_run_by_id(run_id, config):
-    response = requests.get(urljoin(config['beagle_endpoint'], config['api']['run'] + run_id),
-                            headers={'Authorization': 'Bearer %s' % config['token']})
-
-    return response.json()
-
-
-def get_files_by_run_id(run_id, config):
-    response = requests.get(urljoin(config['beagle_endpoint'], config['api']['run'] + run_id),
-                            headers={'Authorization': 'Bearer %s' % config['token']})
+    page = _get_page(config['urls'].run, config, params=run_params)
+    if not page["results"]:
+        print("There are no runs for this id")
+        quit()
 
-    return response.json()["outputs"]
+    # runs come newest first; only keep the most recent job group
+    group_id = page["results"][0]["job_group"]
+    if page["next"]:
+        # more than one page, so let the server filter to the group from here on
+        run_params["job_groups"] = [group_id]
+        page = _get_page(config['urls'].run, config, params=run_params)
+
+    while True:
+        for run in page["results"]:
+            if run["job_group"] == group_id:
+                yield run
+        if not page["next"]:
+            break
+        page = _get_page(page["next"], config)
+
+async def _fetch_run(session, semaphore, run_id, config, retries=5):
+    import aiohttp
+
+    url = config['urls'].run + run_id
+    cached_response = _load_etag(url)
+    headers = {'If-None-Match': cached_response[0]} if cached_response else {}
+    async with semaphore:
+        for attempt in range(retries):
+            last_attempt = attempt == retries - 1
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304 and cached_response:
+                        return _reuse_etag(url, cached_response)
+
+                    # back off while the server is overloaded or erroring
+                    if response.status == 429 or response.status >= 500:
+                        if last_attempt:
+                            response.raise_for_status()
+                    else:
+                        run = await response.json(loads=orjson.loads)
+                        if response.status == 200:
+                            _remember_etag(url, response.headers.get('ETag'), run)
+                        return run
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                # dropped connections and timeouts are overload symptoms too
+                if last_attempt:
+                    raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+async def _gather(run_ids, config):
+    # imported here so non-access commands don't pay for (or break on) aiohttp
+    import aiohttp
+
+    async with aiohttp.ClientSession(headers={'Authorization': 'Bearer %s' % config['token'],
+                                              'Accept': 'application/json'},
+                                     connector=aiohttp.TCPConnector(limit=32)) as session:
+        semaphore = asyncio.Semaphore(32)
+        return await asyncio.gather(*[_fetch_run(session, semaphore, run_id, config) for run_id in run_ids])
+
+def get_files_by_runs(runs, config):
+    # use outputs the run listing already carries; fetch the rest per run
+    outputs = {run["id"]: run["outputs"] for run in runs if "outputs" in run}
+    missing = [run["id"] for run in runs if run["id"] not in outputs]
+    if missing:
+        for run in asyncio.run(_gather(missing, config)):
+            outputs[run["id"]] = run["outputs"]
+    return outputs
+
+def _safe_symlink(src, dst):
+    if os.path.lexists(dst):
+        return False
+    try:
+        os.symlink(src, dst)
+    except FileExistsError:
+        return False
+    except OSError as e:
+        logger.warning("could not create symlink from '%s' to '%s': %s", dst, src, e)
+        return False
+    return True
 
 def get_file_path(file):
     return file["location"][7:]
@@ -97,17 +248,15 @@ def run_access_folder_link_command(arguments, config):
     tags = "cmoSampleIds:%s" % sample_id if sample_id else "requestId:%s" % request_id
     apps = [pipeline["id"]]
 
-    runs = get_runs(tags, apps, config)
+    run_ids = [run["id"] for run in iter_runs(tags, apps, config)]
 
-    files = [] # (sample_id, /path/to/file)
-    for run_meta in runs:
-        run = get_run_by_id(run_meta["id"], config)
-        try:
-            os.symlink(run["output_directory"], path / run["id"])
-        except Exception as e:
-            print("could not create symlink from '{}' to '{}'".format(run["output_directory"], path / run["id"]))
+    runs = asyncio.run(_gather(run_ids, config))
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(_safe_symlink,
+                          [run["output_directory"] for run in runs],
+                          [path / run["id"] for run in runs]))
 
-    os.symlink(path.absolute(), path_without_version / "current")
+    _safe_symlink(path.absolute(), path_without_version / "current")
     return "Completed"
 
 def run_access_folder_bam_link_command(arguments, config):
@@ -116,82 +265,82 @@ def run_access_folder_bam_link_command(arguments, config):
     pipeline = get_pipeline("access legacy", config)
     version = arguments.get("--dir-version") or pipeline["version"]
 
-    path = Path("./")
+    path = str(Path("./").resolve())
 
     tags = "cmoSampleIds:%s" % sample_id if sample_id else "requestId:%s" % request_id
     apps = [pipeline["id"]]
 
-    runs = get_runs(tags, apps, config)
+    runs = list(iter_runs(tags, apps, config))
+    run_ids = [run["id"] for run in runs]
 
-    files = [] # (sample_id, /path/to/file)
-    for run in runs:
-        for file_group in get_files_by_run_id(run["id"], config):
-            files = files + find_files_by_sample(file_group["value"], sample_id=sample_id)
+    outputs = get_files_by_runs(runs, config)
 
-    accepted_file_types = ['.bam', '.bai']
-    for (sample_id, file) in files:
-        file_path = get_file_path(file)
-        _, file_ext = os.path.splitext(file_path)
+    accepted_file_types = frozenset(['.bam', '.bai'])
+    link_dirs = set()
+    links = [] # (symlink future, sample_path, sample_version_path)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for (_, file) in _iter_files(run_ids, outputs, sample_id=sample_id):
+            file_path = get_file_path(file)
+            _, file_ext = os.path.splitext(file_path)
 
-        if file_ext not in accepted_file_types:
-            continue
+            if file_ext not in accepted_file_types:
+                continue
 
-        file_name = os.path.basename(file_path)
+            file_name = os.path.basename(file_path)
 
-        sample_id, _ = file_name.split("_", 1)
-        a, b, _ = sample_id.split("-", 2)
-        patient_id = "-".join([a, b])
+            match = _FILE_NAME_RE.match(file_name)
+            if not match:
+                logger.warning("skipping '%s': can't read patient and sample id from the name", file_path)
+                continue
+            patient_id = match["patient"]
+            file_sample_id = match["sample"]
 
-        sample_path = path / patient_id / sample_id
-        sample_version_path = sample_path / version
-        sample_version_path.mkdir(parents=True, exist_ok=True, mode=0o755)
+            sample_path = os.path.join(path, patient_id, file_sample_id)
+            sample_version_path = os.path.join(sample_path, version)
+            if sample_version_path not in link_dirs:
+                os.makedirs(sample_version_path, mode=0o755, exist_ok=True)
+                link_dirs.add(sample_version_path)
 
-        try:
-            os.symlink(file_path, sample_version_path / file_name)
-        except Exception as e:
-            print("could not create symlink from '{}' to '{}'".format(sample_version_path / file_name, file_path))
-            continue
+            linked = executor.submit(_safe_symlink, file_path, os.path.join(sample_version_path, file_name))
+            links.append((linked, sample_path, sample_version_path))
 
-        try:
-            os.symlink(sample_version_path.absolute(), sample_path / "current")
-        except Exception as e:
-            pass
+    current_links = {}
+    for (linked, sample_path, sample_version_path) in links:
+        if linked.result():
+            current_links[os.path.join(sample_path, "current")] = sample_version_path
+
+    for (link, target) in current_links.items():
+        _safe_symlink(target, link)
 
     return "Completed"
 
+def _iter_files(run_ids, outputs, sample_id=None):
+    for run_id in run_ids:
+        for file_group in outputs[run_id]:
+            yield from find_files_by_sample(file_group["value"], sample_id=sample_id)
+
 def find_files_by_sample(file_group, sample_id = None):
-    def traverse(file_group):
-        files = []
-        if type(file_group) == list:
-            if len(file_group) > 1:
-                return traverse(file_group[0]) + traverse(file_group[1:])
-            elif file_group:
-                return traverse(file_group[0])
-        elif "file" in file_group:
+    stack = [(file_group, sample_id)]
+    while stack:
+        node, node_sample_id = stack.pop()
+        if type(node) == list:
+            stack.extend((child, node_sample_id) for child in reversed(node))
+        elif "file" in node:
             try:
-                file_sample_id = file_group["sampleId"]
-                if "File" == file_group["file"]["class"] and (not sample_id or
-                                                              file_sample_id ==
-                                                              sample_id):
-                    print(file_group["file"]["basename"])
-                    if file_group["file"]["basename"] == "C-0EU9LX-L015-d_cl_aln_srt_MD_IR_FX_BR__aln_srt_IR_FX.bam":
-                        print("Here's our file")
-                        print(file_group["file"]["secondaryFiles"])
-                    return [(file_sample_id, file_group["file"])] + [(file_sample_id,
-                                                                      f) for f in file_group["file"]["secondaryFiles"]]
+                file_sample_id = node["sampleId"]
+                if "File" == node["file"]["class"] and (not node_sample_id or
+                                                        file_sample_id == node_sample_id):
+                    secondary_files = node["file"]["secondaryFiles"]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Found file %s for sample %s", node["file"]["basename"], file_sample_id)
+                    yield (file_sample_id, node["file"])
+                    yield from ((file_sample_id, f) for f in secondary_files)
             except Exception as e:
-                print("ERROR:")
-                print(e)
-                print(file_group)
-        elif "class" in file_group:
-            if file_group["class"] == "Directory":
-                return find_files_by_sample(file_group["listing"], sample_id=file_group["basename"])
+                logger.error("Could not read file group %s: %s", node, e)
+        elif "class" in node:
+            if node["class"] == "Directory":
+                stack.extend((child, node["basename"]) for child in reversed(node["listing"]))
             # TODO pull patient id here
-            elif file_group["class"] == "File":
-                secondary_files = [(sample_id, f) for f in file_group["secondaryFiles"]] if "secondaryFiles" in file_group else []
-                return [(sample_id, file_group)] + secondary_files
-
-        return []
-
-    return traverse(file_group)
-
+            elif node["class"] == "File":
+                yield (node_sample_id, node)
+                yield from ((node_sample_id, f) for f in node.get("secondaryFiles", []))
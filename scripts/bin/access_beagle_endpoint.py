@@ -1,20 +1,28 @@
 import requests
 import sys, os
 import json
+from requests.adapters import HTTPAdapter
+
+_USER = os.environ['BEAGLE_USER']
+_PW = os.environ['BEAGLE_PW']
+_API = os.environ['BEAGLE_ENDPOINT']
+_AUTH = requests.auth.HTTPBasicAuth(_USER, _PW)
+
+_SESSION = requests.Session()
+_SESSION.auth = _AUTH
+_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
 
 class AccessBeagleEndpoint:
   def __init__(self):
-    username = os.environ['BEAGLE_USER']
-    password = os.environ['BEAGLE_PW']
-    BEAGLE_ENDPOINT = os.environ['BEAGLE_ENDPOINT']
-    self.auth = requests.auth.HTTPBasicAuth(username, password)
-    self.API = BEAGLE_ENDPOINT
+    self.auth = _AUTH
+    self.API = _API
+    self.session = _SESSION
 
   def run_url(self, url):
     """
     Runs the url, which should contain all the parameters we'd need
     """
-    req = requests.get(url, auth=self.auth, verify=False)
+    req = self.session.get(url)
     return req.json()
 
   # had to build url weird because the requests docs were busted and I kept running into issues
@@ -30,11 +38,7 @@ class AccessBeagleEndpoint:
 
   def get_file_ids(self, request_id):
     url =  "%s/v0/fs/files/?page_size=1000&metadata=requestId:%s" % (self.API, request_id)
-    data = self.run_url(url)
-    file_ids = list()
-    for result in data['results']:
-      file_ids.append(result['id'])
-    return file_ids
+    return [result['id'] for result in self.run_url(url)['results']]
 
   def get_file_id_by_path(self, path):
     url =  "%s/v0/fs/files/?page_size=1000&path=%s" % (self.API, path)